@@ -1,11 +1,13 @@
 import csv
+import ctypes
+import ctypes.wintypes
 import datetime
-from contextlib import contextmanager
-
-import pytz
+import functools
 import itertools
+import os
 from collections import namedtuple
-from winevt import EventLog
+from contextlib import closing, contextmanager
+from operator import attrgetter
 
 # This program must be run as an Administrator.
 # Tune this date:
@@ -36,67 +38,172 @@ EventData = namedtuple('EventData', [
 # "1074" - " Shutdown Type: power off".
 
 
-def isStartEvent(event_id):
-    return event_id in ['4801']
-    #return event_id in ['4801', '4624', '6005', '4803']
+# Event ID -> True for start (log in) events, False for end (log out) events.
+EVENT_BEGINS = {4801: True, 4800: False, 7002: False, 1074: False}
+#EVENT_BEGINS = {4801: True, 4624: True, 6005: True, 4803: True, 4800: False, 7002: False, 1074: False, 4647: False, 4802: False}
+
+
+# Windows Event Log API (wevtapi.dll) values, see winevt.h.
+EvtQueryChannelPath = 0x1
+EvtQueryReverseDirection = 0x200
+EvtRenderContextValues = 0
+EvtRenderEventValues = 0
+EvtVarTypeUInt16 = 6
+EvtVarTypeFileTime = 17
+ERROR_NO_MORE_ITEMS = 259
+INFINITE = 0xFFFFFFFF
+
+EVENT_BATCH_SIZE = 1024     # Number of event handles fetched per EvtNext call.
+FILETIME_EPOCH = datetime.datetime(1601, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class EVT_VARIANT(ctypes.Structure):
+    _fields_ = [
+        ('Value', ctypes.c_uint64),         # Union of all value types; we only read UInt16 and FILETIME.
+        ('Count', ctypes.wintypes.DWORD),
+        ('Type', ctypes.wintypes.DWORD),
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def load_wevtapi():
+    """
+    Loads wevtapi.dll and declares the signatures of the functions we use.
+    Loaded once per process.
+    :return: ctypes library object.
+    """
+    HANDLE = ctypes.wintypes.HANDLE
+    DWORD = ctypes.wintypes.DWORD
+    PDWORD = ctypes.POINTER(DWORD)
+
+    wevtapi = ctypes.WinDLL('wevtapi', use_last_error=True)
+    wevtapi.EvtQuery.argtypes = [HANDLE, ctypes.wintypes.LPCWSTR, ctypes.wintypes.LPCWSTR, DWORD]
+    wevtapi.EvtQuery.restype = HANDLE
+    wevtapi.EvtNext.argtypes = [HANDLE, DWORD, ctypes.POINTER(HANDLE), DWORD, DWORD, PDWORD]
+    wevtapi.EvtNext.restype = ctypes.wintypes.BOOL
+    wevtapi.EvtCreateRenderContext.argtypes = [DWORD, ctypes.POINTER(ctypes.wintypes.LPCWSTR), DWORD]
+    wevtapi.EvtCreateRenderContext.restype = HANDLE
+    wevtapi.EvtRender.argtypes = [HANDLE, HANDLE, DWORD, DWORD, ctypes.c_void_p, PDWORD, PDWORD]
+    wevtapi.EvtRender.restype = ctypes.wintypes.BOOL
+    wevtapi.EvtClose.argtypes = [HANDLE]
+    wevtapi.EvtClose.restype = ctypes.wintypes.BOOL
+    return wevtapi
+
+
+@functools.lru_cache(maxsize=None)
+def event_log_render_state():
+    """
+    Creates the EventID/TimeCreated render context and the buffers used with it.
+    Created once per process and shared by all queries (handles are copied out of the buffer before use).
+    :return: (render context handle, EVT_HANDLE buffer for EvtNext, EVT_VARIANT buffer for EvtRender)
+    """
+    wevtapi = load_wevtapi()
+    value_paths = (ctypes.wintypes.LPCWSTR * 2)('Event/System/EventID', 'Event/System/TimeCreated/@SystemTime')
+    context = wevtapi.EvtCreateRenderContext(len(value_paths), value_paths, EvtRenderContextValues)
+    if not context:
+        raise ctypes.WinError(ctypes.get_last_error())
+    handles = (ctypes.wintypes.HANDLE * EVENT_BATCH_SIZE)()
+    values = (EVT_VARIANT * len(value_paths))()
+    return context, handles, values
 
 
-def isEndEvent(event_id):
-    return event_id in ['4800', '7002', '1074']
-    #return event_id in ['4800', '7002', '1074', '4647', '4802']
+def query_event_log(channel, xpath, tz):
+    """
+    Reads events from one event log channel, newest first.
+    Events are fetched in batches and only EventID and TimeCreated are rendered (as values, not as XML).
+    :param channel:             Channel name, e.g. 'Security'.
+    :param xpath:               XPath filter for the channel.
+    :param tz:                  Fixed-offset tzinfo of the returned datetimes.
+    :return: Generator of (event_id, time) tuples; event_id is an int, time is a datetime in tz.
+    """
+    wevtapi = load_wevtapi()
+    context, handles, values = event_log_render_state()
+    # Shifting the epoch once lets us skip an astimezone() call per event.
+    epoch = FILETIME_EPOCH.astimezone(tz)
+
+    query = wevtapi.EvtQuery(None, channel, xpath, EvtQueryChannelPath | EvtQueryReverseDirection)
+    if not query:
+        raise ctypes.WinError(ctypes.get_last_error())
+
+    returned = ctypes.wintypes.DWORD()
+    buffer_used = ctypes.wintypes.DWORD()
+    property_count = ctypes.wintypes.DWORD()
+    try:
+        while True:
+            if not wevtapi.EvtNext(query, len(handles), handles, INFINITE, 0, ctypes.byref(returned)):
+                error = ctypes.get_last_error()
+                if error == ERROR_NO_MORE_ITEMS:
+                    break
+                raise ctypes.WinError(error)
+
+            batch = handles[:returned.value]
+            try:
+                for handle in batch:
+                    if not wevtapi.EvtRender(context, handle, EvtRenderEventValues, ctypes.sizeof(values), values,
+                                             ctypes.byref(buffer_used), ctypes.byref(property_count)):
+                        raise ctypes.WinError(ctypes.get_last_error())
+                    event_id, time_created = values
+                    if event_id.Type != EvtVarTypeUInt16 or time_created.Type != EvtVarTypeFileTime:
+                        continue
+                    # FILETIME is a count of 100ns ticks since 1601-01-01 UTC; keep whole seconds only, as reports do.
+                    time = epoch + datetime.timedelta(seconds=time_created.Value // 10_000_000)
+                    yield event_id.Value & 0xFFFF, time
+            finally:
+                for handle in batch:
+                    wevtapi.EvtClose(handle)
+    finally:
+        wevtapi.EvtClose(query)
 
 
 def load_data_from_event_log(date_start):
-    # We need this date format: '2019-06-01T09:03:26.000Z'
     date_start = datetime.datetime.fromisoformat(date_start).astimezone()
-    date_end = datetime.datetime.now().astimezone()
-    #date_start = date_start.astimezone(pytz.utc)
-    #date_end = date_end.astimezone(pytz.utc)
-    #date_start = date_start.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-    #date_end = date_end.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-    milliseconds = int((date_end - date_start).total_seconds() * 1000)
-
-    # This query was constructed using Event Viewer.
-    # See this tutorial: https://blogs.technet.microsoft.com/askds/2011/09/26/advanced-xml-filtering-in-the-windows-event-viewer/
-    # Note: Simpler query syntax is also supported. See here: https://github.com/bannsec/winevt
-    #eventsCondition = '((EventID &gt;= 4800 and EventID &lt;= 4810) or EventID=4648 or EventID=4647 or EventID=7002 or EventID=1074)'
-    eventsCondition = '(EventID=4800 or EventID=4801 or EventID=7002 or EventID=1074)'
-    #dateCondition = f"TimeCreated[@SystemTime&gt;='{date_start}' and @SystemTime&lt;='{date_end}']"
-    #dateCondition = "TimeCreated[@SystemTime&gt;='2019-06-01T09:03:26.000Z' and @SystemTime&lt;='2019-06-04T09:10:15.999Z']"
-    #dateCondition = "TimeCreated[timediff(@SystemTime) &lt;= 2592000000]"
-    dateCondition = f"TimeCreated[timediff(@SystemTime) &lt;= {milliseconds}]"
-    structuredQuery = f'''
-    <QueryList>
-      <Query Id="0" Path="Security">
-        <Select Path="Security">*[System[{eventsCondition} and {dateCondition}]]</Select>
-        <Select Path="System">*[System[{eventsCondition} and {dateCondition}]]</Select>
-      </Query>
-    </QueryList>
-    '''
-
-    query = EventLog.Query('', structuredQuery)
-    events = list(query)
+    local_tz = date_start.tzinfo
 
+    # XPath filters can be constructed using Event Viewer.
+    # See this tutorial: https://blogs.technet.microsoft.com/askds/2011/09/26/advanced-xml-filtering-in-the-windows-event-viewer/
+    # Each channel is only asked for the IDs it can contain: lock/unlock events come from Security auditing,
+    # while Winlogon logoff (7002) and shutdown (1074) events are logged to System.
+    #securityXPath = '*[System[((EventID >= 4800 and EventID <= 4810) or EventID=4648 or EventID=4647)]]'
+    securityXPath = '*[System[(EventID=4800 or EventID=4801)]]'
+    systemXPath = '*[System[(EventID=7002 or EventID=1074)]]'
+
+    # Channels are read newest first, so instead of a time condition in the XPath
+    # (which makes the service test every record) we stop at the first event older than date_start.
     event_datas = []
-    for event in events:
-        beginEvent = isStartEvent(str(event.EventID))
-        endEvent = isEndEvent(str(event.EventID))
-        if (not beginEvent) and (not endEvent):
-            continue
-        timestr = event.System.TimeCreated['SystemTime']
-        (time, nSecs) = timestr.split('.')
-        time = datetime.datetime.strptime(f'{time}.UTC', '%Y-%m-%dT%H:%M:%S.%Z')
-        time = time.replace(tzinfo=pytz.utc)
-        time = time.astimezone(date_start.tzinfo)
-        data = EventData(begin=beginEvent, time=time)
-        event_datas.append(data)
+    for channel, xpath in [('Security', securityXPath), ('System', systemXPath)]:
+        with closing(query_event_log(channel, xpath, local_tz)) as events:
+            for event_id, time in events:
+                if time < date_start:
+                    break
+                beginEvent = EVENT_BEGINS.get(event_id)
+                if beginEvent is None:
+                    continue
+                data = EventData(begin=beginEvent, time=time)
+                event_datas.append(data)
 
     return event_datas
 
 
+def parse_csv_datetime(text):
+    """
+    Parses Event Viewer's date format, e.g. "6/26/2019 6:57:11 PM".
+    Equivalent to strptime(text, '%m/%d/%Y %I:%M:%S %p'), but splits the fixed format by hand,
+    which is several times faster than strptime.
+    :param text:    Date and time string.
+    :return: Naive datetime.
+    """
+    date, time, am_pm = text.split(' ')
+    month, day, year = date.split('/')
+    hour, minute, second = time.split(':')
+    hour = int(hour) % 12
+    if am_pm.upper() == 'PM':
+        hour += 12
+    return datetime.datetime(int(year), int(month), int(day), hour, int(minute), int(second))
+
+
 def load_data_from_csv(file_name):
     """
-    Returns list of lists of values from the CSV.
+    Loads lock/unlock events from the CSV.
     Format as from Event Viewer:
         - no column headers,
         - Level	DateAndTime	Source	EventID	TaskCategory"
@@ -104,13 +211,18 @@ def load_data_from_csv(file_name):
     :param file_name:   TSV file.
     :return: List of EventData tuples.
     """
+    # Stream the rows: filter events and convert dates to datetime in a single pass.
+    event_data = []
     with open(file_name, newline='') as csvfile:
         reader = csv.reader(csvfile, dialect='excel-tab')
-        raw_event_data = list(reader)
-
-    # Convert dates to datetime.
-    filtered_raw_data = [event for event in raw_event_data if isStartEvent(event[3]) or isEndEvent(event[3])]
-    event_data = [EventData(begin=isStartEvent(event[3]), time=datetime.datetime.strptime(event[1], '%m/%d/%Y %I:%M:%S %p')) for event in filtered_raw_data]
+        for event in reader:
+            # Rows with a non-numeric EventID (e.g. a header row) are skipped like any other event.
+            event_id = event[3]
+            beginEvent = EVENT_BEGINS.get(int(event_id)) if event_id.isdecimal() else None
+            if beginEvent is None:
+                continue
+            time = parse_csv_datetime(event[1])
+            event_data.append(EventData(begin=beginEvent, time=time))
 
     return event_data
 
@@ -125,6 +237,15 @@ WorkTime = namedtuple('WorkTime', [
     'warnings',             # List of warning strings.
     'events',               # List of events [EventData, ...]
     'paired_events',        # List of paired events [(EventData, EventData), ...]
+    'day_start',            # datetime of midnight at the start of the day.
+    'day_end',              # datetime of the last second of the day (23:59:59).
+    # Preformatted strings shared by the text and HTML reports:
+    'date_str',             # date as 'YYYY-MM-DD (Day)'.
+    'start_str',            # start_time as 'HH:MM'.
+    'end_str',              # end_time as 'HH:MM'.
+    'duration_str',         # str(duration)
+    'logged_in_str',        # str(logged_in_duration)
+    'logged_out_str',       # str(logged_out_duration)
 ])
 
 def compute_times(event_data):
@@ -155,7 +276,7 @@ def compute_times(event_data):
         global_warnings.append(f'Ignoring too early event: {event}')
 
     # Sort by datetimes.
-    event_data.sort(key=lambda event: event.time)
+    event_data.sort(key=attrgetter('time'))
 
     # Group by days.
     day_events = []
@@ -173,27 +294,27 @@ def compute_times(event_data):
            Compute logged_in_duration.
            Warn if logged_in_duration if more than 1 hour less than duration.
 
-        :param events: Events for one day.
+        :param events: Events for one day (not empty).
         :return: WorkTime or None if work time could not be computed.
         """
         paired_events = []
         day_warnings = []
 
-        if len(events) > 0 and (not events[0].begin):
-            event = events[0]
-            syn_time = datetime.datetime(event.time.year, event.time.month, event.time.day, tzinfo=event.time.tzinfo)
-            syn_event = EventData(begin=True, time=syn_time)
-            day_warnings.append(f'Synthesized log in at midnight {syn_event} for: {event}')
-            events.insert(0, syn_event)
-
-        if len(events) > 0 and events[-1].begin:
-            event = events[-1]
-            syn_time = datetime.datetime(event.time.year, event.time.month, event.time.day, tzinfo=event.time.tzinfo) + datetime.timedelta(days=1)
-            syn_event = EventData(begin=False, time=syn_time)
-            day_warnings.append(f'Synthesized log out at midnight {syn_event} for: {event}')
-            events.append(syn_event)
-
-        startEvent = None
+        first_time = events[0].time
+        day_start = datetime.datetime(first_time.year, first_time.month, first_time.day, tzinfo=first_time.tzinfo)
+
+        # Synthesized midnight events are paired on the fly, without inserting them into events.
+        syn_begin = None
+        syn_end = None
+        if not events[0].begin:
+            syn_begin = EventData(begin=True, time=day_start)
+            day_warnings.append(f'Synthesized log in at midnight {syn_begin} for: {events[0]}')
+
+        if events[-1].begin:
+            syn_end = EventData(begin=False, time=day_start + datetime.timedelta(days=1))
+            day_warnings.append(f'Synthesized log out at midnight {syn_end} for: {events[-1]}')
+
+        startEvent = syn_begin
         for event in events:
             if startEvent is None:
                 if event.begin:
@@ -208,10 +329,16 @@ def compute_times(event_data):
                 paired_events.append((startEvent, event))
                 startEvent = None
 
+        if syn_end is not None:
+            # The day ends logged in, so startEvent is still open.
+            paired_events.append((startEvent, syn_end))
+            events = events + [syn_end]
+        if syn_begin is not None:
+            events = [syn_begin] + events
+
         if len(paired_events) == 0:
             day_warnings.append(f'No events left for day: {events[0].time.date()}')
-            nonlocal global_warnings
-            global_warnings += day_warnings
+            global_warnings.extend(day_warnings)
             return None
 
         start_date = paired_events[0][0].time
@@ -219,8 +346,7 @@ def compute_times(event_data):
         start_time = start_date.time()
         end_time = end_date.time()
         duration = end_date - start_date
-        durations = [end_event.time - start_event.time for start_event, end_event in paired_events]
-        logged_in_duration = sum(durations, datetime.timedelta(hours=0))
+        logged_in_duration = sum((end_event.time - start_event.time for start_event, end_event in paired_events), datetime.timedelta())
         logged_out_duration = duration - logged_in_duration
 
         if logged_in_duration < datetime.timedelta(hours=6):
@@ -228,7 +354,8 @@ def compute_times(event_data):
         if logged_out_duration > datetime.timedelta(hours=1):
             day_warnings.append(f'Logged out duration is large: {logged_out_duration}')
 
-        return WorkTime(date=events[0].time.date(),
+        date = events[0].time.date()
+        return WorkTime(date=date,
                         start_time=start_time,
                         end_time=end_time,
                         duration=duration,
@@ -236,7 +363,15 @@ def compute_times(event_data):
                         logged_out_duration=logged_out_duration,
                         warnings=day_warnings,
                         events=events,
-                        paired_events=paired_events)
+                        paired_events=paired_events,
+                        day_start=day_start,
+                        day_end=day_start + datetime.timedelta(hours=23, minutes=59, seconds=59),
+                        date_str=date.strftime('%Y-%m-%d (%a)'),
+                        start_str=start_time.strftime('%H:%M'),
+                        end_str=end_time.strftime('%H:%M'),
+                        duration_str=str(duration),
+                        logged_in_str=str(logged_in_duration),
+                        logged_out_str=str(logged_out_duration))
 
     work_times = []
     for events in day_events:
@@ -263,34 +398,41 @@ def output_report(global_warnings, work_times):
         if is_monday == 0:
             print('------- NEW WEEK -------')
 
-        date = work_time.date.strftime('%Y-%m-%d (%a)')
-        start_time = work_time.start_time.strftime('%H:%M')
-        end_time = work_time.end_time.strftime('%H:%M')
-        duration = str(work_time.duration)
-        logged_in_duration = str(work_time.logged_in_duration)
-        logged_out_duration = str(work_time.logged_out_duration)
-        print(f'Day: {date} Times: {start_time} {end_time} Duration: {duration} logged-in={logged_in_duration} logged-out={logged_out_duration}')
+        print(f'Day: {work_time.date_str} Times: {work_time.start_str} {work_time.end_str} Duration: {work_time.duration_str} logged-in={work_time.logged_in_str} logged-out={work_time.logged_out_str}')
         if len(work_time.warnings) > 0:
             print('  Warnings:')
             for warning in work_time.warnings:
                 print(f'    - {warning}')
 
 
-def generate_html_report(global_warnings, work_times):
+# Span CSS class, indexed by (prev_begin << 1) | cur_begin.
+SPAN_CLASSES = ('logged-out-out', 'logged-out-in', 'logged-in-out', 'logged-in-in')
+# Timeline spans are emitted once per event, so they bypass tag() and style().
+SPAN_TEMPLATE = '<div class="span {cls}" style="height: 20px; width: {width}px; display: inline-block; margin: 0; padding: 0" title="{title}"></div>'
+
+
+def generate_html_report(global_warnings, work_times, report_file):
     """
-    Generates an HTML report.
+    Generates an HTML report, streaming it to a text file.
     :param global_warnings:     List of strings.
     :param work_times:          List of WorkTimes.
-    :return: List of HTML lines.
+    :param report_file:         Text file object to write the HTML to.
     """
     indent = 0
-    result_lines = []
+    indent_strs = ['']
+
+    def _indent_str(level):
+        while len(indent_strs) <= level:
+            indent_strs.append(indent_strs[-1] + '  ')
+        return indent_strs[level]
 
     def _raw_out(txt, same_line):
         if same_line:
-            result_lines.append(txt)
+            report_file.write(txt)
         else:
-            result_lines.append(f'{"  " * indent}{txt}\n')
+            report_file.write(_indent_str(indent))
+            report_file.write(txt)
+            report_file.write('\n')
 
     @contextmanager
     def _out_cm(end, same_line):
@@ -307,14 +449,26 @@ def generate_html_report(global_warnings, work_times):
         _raw_out(txt, same_line=same_line)
         return _out_cm(end, same_line=same_line)
 
-    def tag(name, same_line=False, **attributes):
+    def _tag_strs(name, attributes):
         atts = ''
         if len(attributes) > 0:
             atts = ' ' + ' '.join([f'{key}="{value}"' for key, value in attributes.items()])
-        start = f'<{name}{atts}>'
-        end = f'</{name}>'
+        return f'<{name}{atts}>', f'</{name}>'
+
+    def tag(name, same_line=False, **attributes):
+        start, end = _tag_strs(name, attributes)
         return out(start, end, same_line=same_line)
 
+    def list_items(items, **attributes):
+        """
+        Outputs one <li> per item, formatted the same way as tag('li', ...) with out(item) inside,
+        but as plain string concatenation instead of a context manager per item.
+        """
+        start, end = _tag_strs('li', attributes)
+        head = f'{_indent_str(indent)}{start}\n{_indent_str(indent + 1)}'
+        tail = f'\n{_indent_str(indent)}{end}\n'
+        report_file.write(''.join([f'{head}{item}{tail}' for item in items]))
+
     def style(**styles):
         return '; '.join([f'{key.replace("_", "-")}: {value}' for key, value in styles.items()])
 
@@ -331,7 +485,7 @@ def generate_html_report(global_warnings, work_times):
     with tag('html'):
         with tag('head'):
             with tag('style'):
-                result_lines.extend(css.split('\n'))
+                _raw_out(css, same_line=True)
 
         with tag('body'):
 
@@ -341,9 +495,7 @@ def generate_html_report(global_warnings, work_times):
                 with tag('h1'):
                     out('Global warnings')
                 with tag('ul'):
-                    for warning in global_warnings:
-                        with tag('li', style=warning_style):
-                            out(warning)
+                    list_items(global_warnings, style=warning_style)
 
             out('')
 
@@ -356,53 +508,37 @@ def generate_html_report(global_warnings, work_times):
                         with tag('h1'):
                             out('NEW WEEK')
 
-                    date = work_time.date.strftime('%Y-%m-%d (%a)')
-                    start_time = work_time.start_time.strftime('%H:%M')
-                    end_time = work_time.end_time.strftime('%H:%M')
-                    duration = str(work_time.duration)
-                    logged_in_duration = str(work_time.logged_in_duration)
-                    logged_out_duration = str(work_time.logged_out_duration)
                     with tag('div'):
-                        out(f'Day: {date} Times: {start_time} {end_time} Duration: {duration} Logged in: logged-in={logged_in_duration} logged-out={logged_out_duration}')
+                        out(f'Day: {work_time.date_str} Times: {work_time.start_str} {work_time.end_str} Duration: {work_time.duration_str} Logged in: logged-in={work_time.logged_in_str} logged-out={work_time.logged_out_str}')
                         if len(work_time.events) > 0:
                             with tag('div'):
-                                def time_to_pos(time):
-                                    return 60 * time.hour + time.minute
-                                event = work_time.events[0]
-                                day_start = datetime.datetime(event.time.year, event.time.month, event.time.day, tzinfo=event.time.tzinfo)
-                                day_end = day_start + datetime.timedelta(hours=23, minutes=59, seconds=59)
+                                day_start = work_time.day_start
+                                day_end = work_time.day_end
                                 last_time = day_start
-                                events = [EventData(begin=False, time=day_start)] + [event for evs in work_time.paired_events for event in evs] + [EventData(begin=False, time=day_end)]
-                                events = [EventData(begin=event.begin, time=min(event.time, day_end)) for event in events]
+                                last_pos = 0    # Timeline position (in minutes of the day) of last_time.
+                                # Single pass: flatten the pairs and clamp them to the end of the day.
+                                events = [EventData(begin=False, time=day_start)]
+                                events.extend(event if event.time <= day_end else event._replace(time=day_end)
+                                              for evs in work_time.paired_events for event in evs)
+                                events.append(EventData(begin=False, time=day_end))
                                 cur_begin = events[0].begin
                                 for event in events:
                                     prev_begin = cur_begin
                                     cur_begin = event.begin
-                                    start_pos = time_to_pos(last_time)
-                                    end_pos = time_to_pos(event.time)
-                                    if prev_begin and not cur_begin:
-                                        cls = 'logged-in-out'
-                                    elif (not prev_begin) and cur_begin:
-                                        cls = 'logged-out-in'
-                                    elif prev_begin and cur_begin:
-                                        cls = 'logged-in-in'
-                                    else:
-                                        cls = 'logged-out-out'
+                                    start_pos = last_pos
+                                    end_pos = 60 * event.time.hour + event.time.minute
+                                    cls = SPAN_CLASSES[(prev_begin << 1) | cur_begin]
 
                                     title = f'Duration: {event.time - last_time}\nStart time: {last_time}\nEnd time: {event.time}\n{cls}'
 
-                                    with tag('div', same_line=True, **{ 'class': f'span {cls}' }, style=style(height='20px', width=f'{end_pos - start_pos}px', display='inline-block', margin='0', padding='0'), title=title):
-                                        pass
+                                    _raw_out(SPAN_TEMPLATE.format(cls=cls, width=end_pos - start_pos, title=title), same_line=True)
 
                                     last_time = event.time
+                                    last_pos = end_pos
 
                         if len(work_time.warnings) > 0:
                             with tag('ul'):
-                                for warning in work_time.warnings:
-                                    with tag('li', style=warning_style):
-                                        out(warning)
-
-    return result_lines
+                                list_items(work_time.warnings, style=warning_style)
 
 
 def main():
@@ -412,9 +548,16 @@ def main():
     global_warnings, work_times = compute_times(events)
     output_report(global_warnings, work_times)
 
-    html_report = generate_html_report(global_warnings, work_times)
-    with open('report.html', 'wt') as f:
-        f.writelines(html_report)
+    # The report is streamed to a temporary file and moved into place only when complete,
+    # so a failure does not replace the previous report with a partial one.
+    # Large buffer: the report is written in many small pieces.
+    try:
+        with open('report.html.tmp', 'wt', buffering=1 << 20) as f:
+            generate_html_report(global_warnings, work_times, f)
+    except BaseException:
+        os.remove('report.html.tmp')
+        raise
+    os.replace('report.html.tmp', 'report.html')
 
 
 if __name__ == '__main__':